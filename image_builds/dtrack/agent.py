@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
 import os
-import json
-import base64
+import hashlib
+import multiprocessing
 import socket
 import subprocess
+import tempfile
+import threading
 import time
 import re
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, UTC
 
+import ijson
+import orjson
 import requests
+import requests_unixsocket
+import zstandard
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util import Retry
 
 # ========= Config from environment =========
 DT_URL = os.environ.get("DT_URL")
@@ -17,13 +29,54 @@ DT_PROJECT_NAME = os.environ.get("DT_PROJECT_NAME")  # logical root/app/service
 DT_PROJECT_VERSION_BASE = os.environ.get("DT_PROJECT_VERSION", "v0.0.0")
 SCAN_INTERVAL_SECONDS = int(os.environ.get("SCAN_INTERVAL_SECONDS", "3600"))
 SERVER_HOSTNAME = os.environ.get("SERVER_HOSTNAME")
+SBOM_CACHE_DIR = os.environ.get("DTRACK_SBOM_CACHE_DIR", "/var/cache/dtrack-agent")
+SBOM_CACHE_MAX_AGE_DAYS = int(os.environ.get("DTRACK_SBOM_CACHE_MAX_AGE_DAYS", "30"))
+DISABLE_SBOM_CACHE = os.environ.get("DTRACK_DISABLE_SBOM_CACHE", "").lower() in ("1", "true", "yes")
+MAX_CONCURRENCY = int(os.environ.get("DTRACK_MAX_CONCURRENCY", "4"))
+FULL_RESCAN_SECONDS = int(os.environ.get("DTRACK_FULL_RESCAN_SECONDS", "86400"))
+BOM_WAIT_SECONDS = int(os.environ.get("DTRACK_BOM_WAIT_SECONDS", "300"))
+PODMAN_SOCKET_PATH = os.environ.get("PODMAN_SOCKET_PATH", "/run/podman/podman.sock")
 
 if not DT_URL or not DT_API_KEY or not DT_PROJECT_NAME:
     raise SystemExit("DT_URL, DT_API_KEY and DT_PROJECT_NAME must be set")
 
 DT_URL = DT_URL.rstrip("/")
 
-SESSION = requests.Session()
+# Retried on every Dependency-Track call, with backoff (1s, 2s, 4s, ...)
+DT_RETRY_STATUSES = (429, 502, 503, 504)
+DT_RETRY = Retry(
+    total=5,
+    connect=3,
+    read=3,
+    backoff_factor=1,
+    status_forcelist=DT_RETRY_STATUSES,
+    # POST is retried by upload_bom() itself: its streamed body can't be rewound
+    allowed_methods=frozenset(["GET", "PUT", "PATCH"]),
+    raise_on_status=False,
+)
+# Circuit breaker: when more than half of the last CIRCUIT_WINDOW calls
+# failed, pause, probe DTrack, and only fill the SBOM cache while it stays down
+CIRCUIT_WINDOW = 10
+CIRCUIT_COOLDOWN_SECONDS = 60
+
+
+class DTSession(requests.Session):
+    """
+    requests.Session that feeds the outcome of every call (after retries)
+    into the circuit breaker.
+    """
+
+    def request(self, *args, **kwargs):
+        try:
+            r = super().request(*args, **kwargs)
+        except requests.RequestException:
+            record_dt_result(False)
+            raise
+        record_dt_result(r.status_code < 500 and r.status_code != 429)
+        return r
+
+
+SESSION = DTSession()
 SESSION.headers.update(
     {
         "X-Api-Key": DT_API_KEY,
@@ -31,37 +84,127 @@ SESSION.headers.update(
         "Accept": "application/json",
     }
 )
+# Keep-alive pool sized for the scan workers
+_DT_ADAPTER = HTTPAdapter(
+    pool_connections=2,
+    pool_maxsize=max(16, MAX_CONCURRENCY),
+    max_retries=DT_RETRY,
+)
+SESSION.mount("http://", _DT_ADAPTER)
+SESSION.mount("https://", _DT_ADAPTER)
+
+# Unix socket session for Podman API, kept open across scan cycles
+PODMAN_SESSION = requests_unixsocket.Session()
+PODMAN_SESSION.mount("http+unix://", requests_unixsocket.UnixAdapter(pool_connections=1))
+PODMAN_BASE = f"http+unix://{PODMAN_SOCKET_PATH.replace('/', '%2F')}"
 
 # make syft behave nicely in our environment
 os.environ.setdefault("SYFT_CHECK_FOR_APP_UPDATE", "false")
-os.environ.setdefault("DOCKER_HOST", "unix:///run/podman/podman.sock")
+os.environ.setdefault("DOCKER_HOST", f"unix://{PODMAN_SOCKET_PATH}")
+
+
+_LOG_LOCK = threading.Lock()
+# one pool for the agent's lifetime, so containers still running past a
+# cycle's deadline keep occupying a worker instead of piling up threads;
+# BOM status polling is queued here too
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix="scan")
+# BOM parse + license sanitizing is CPU-bound Python, so it runs in worker
+# processes (see parse_pool()) to keep scan threads from serializing on the GIL
+_PARSE_POOL: ProcessPoolExecutor | None = None
+_PARSE_POOL_LOCK = threading.Lock()
+# license URLs CycloneDX will accept; anything else is stripped
+_URL_RE = re.compile(r"^(https?|ftp)://[^\s/$.?#].[^\s]*$")
+# (today, project_name, project_version) -> uuid for projects already
+# found/created; earlier days are dropped by prune_project_cache()
+_PROJECT_CACHE: dict[tuple[str, str, str], str] = {}
+# serializes lookup/create per project so concurrent workers cannot race to
+# create the same one
+_PROJECT_LOCKS: dict[tuple[str, str, str], threading.Lock] = defaultdict(threading.Lock)
+# container name -> what was last uploaded for it (image_id, project_uuid,
+# content_sha256, scanned_at), so unchanged containers can be skipped
+_LAST_SEEN: dict[str, dict] = {}
+# names of containers with a scan submitted and not finished yet; a scan
+# still running past its cycle's deadline can't be cancelled, so the next
+# cycle must not start a second one alongside it
+_IN_FLIGHT: set[str] = set()
+_IN_FLIGHT_LOCK = threading.Lock()
+# outcomes (True = ok) of the most recent Dependency-Track calls
+_DT_RESULTS: deque[bool] = deque(maxlen=CIRCUIT_WINDOW)
+_DT_RESULTS_LOCK = threading.Lock()
 
 
 # ========= Helpers =========
 def log(msg: str) -> None:
     now = datetime.now(UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
-    print(f"[{now}] {msg}", flush=True)
+    with _LOG_LOCK:
+        print(f"[{now}] {msg}", flush=True)
+
+
+def record_dt_result(ok: bool) -> None:
+    with _DT_RESULTS_LOCK:
+        _DT_RESULTS.append(ok)
+
+
+def dt_circuit_open() -> bool:
+    """
+    True when more than half of the last CIRCUIT_WINDOW DTrack calls failed.
+    """
+    with _DT_RESULTS_LOCK:
+        return len(_DT_RESULTS) == CIRCUIT_WINDOW and _DT_RESULTS.count(False) * 2 > CIRCUIT_WINDOW
+
+
+def reset_dt_circuit() -> None:
+    with _DT_RESULTS_LOCK:
+        _DT_RESULTS.clear()
+
+
+def probe_dt() -> bool:
+    """
+    One real request to DTrack, so an open circuit is judged on how it
+    responds now rather than on results left over from an earlier cycle.
+    """
+    try:
+        r = SESSION.get(f"{DT_URL}/api/version")
+    except Exception as e:
+        log(f"WARNING: Dependency-Track probe failed: {e}")
+        return False
+    if r.status_code != 200:
+        log(f"WARNING: Dependency-Track probe failed: {r.status_code}")
+        return False
+    return True
+
+
+def parse_pool(broken: ProcessPoolExecutor | None = None) -> ProcessPoolExecutor:
+    """
+    The process pool for rewrite_bom_file(), created on first use so the
+    worker processes, which re-import this module, don't each build one.
+
+    Passing the pool that raised BrokenProcessPool (a worker died, e.g.
+    OOM-killed on a huge BOM) replaces it, unless another thread already has.
+    forkserver avoids forking this (threaded) process directly.
+    """
+    global _PARSE_POOL
+    with _PARSE_POOL_LOCK:
+        if _PARSE_POOL is None or _PARSE_POOL is broken:
+            if broken is not None:
+                log("WARNING: BOM parse worker died, restarting the process pool")
+                broken.shutdown(wait=False, cancel_futures=True)
+            _PARSE_POOL = ProcessPoolExecutor(
+                max_workers=min(MAX_CONCURRENCY, os.cpu_count() or 1),
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+        return _PARSE_POOL
 
 
 def discover_containers():
     """
-    Use Podman's Docker-compatible HTTP API over /run/podman/podman.sock
-    to discover running containers and their images.
+    Use Podman's libpod HTTP API over PODMAN_SOCKET_PATH to discover
+    running containers and their images.
     """
     try:
-        out = subprocess.check_output(
-            [
-                "curl",
-                "--unix-socket",
-                "/run/podman/podman.sock",
-                "-s",
-                "-H",
-                "Content-Type: application/json",
-                "http://d/containers/json",
-            ],
-            text=True,
-        )
-        data = json.loads(out)
+        r = PODMAN_SESSION.get(f"{PODMAN_BASE}/v4.0.0/libpod/containers/json", timeout=5)
+        r.raise_for_status()
+        data = r.json()
     except Exception as e:
         log(f"ERROR: failed to query podman socket: {e}")
         return []
@@ -76,6 +219,7 @@ def discover_containers():
                 "id": c.get("Id"),
                 "name": name,
                 "image": c.get("Image"),
+                "image_id": c.get("ImageID"),
             }
         )
     
@@ -86,49 +230,264 @@ def discover_containers():
     return containers
 
 
-def sanitize_licenses(bom: dict) -> None:
+def _first_expression(lic, url_re: re.Pattern) -> dict | None:
+    """
+    Return {"expression": ...} for one CycloneDX license entry, or None if it
+    has nothing usable. Invalid URLs are stripped from entries without one.
     """
-    Fix the 'licenses' field to be CycloneDX-friendly:
+    if not isinstance(lic, dict):
+        return None
+
+    get = lic.get
+    expr = get("expression")
+    if isinstance(expr, str):
+        return {"expression": expr}
+
+    lic_obj = get("license")
+    if not isinstance(lic_obj, dict):
+        return None
+    if "id" in lic_obj:
+        return {"expression": lic_obj["id"]}
+    if "name" in lic_obj:
+        return {"expression": lic_obj["name"]}
+    if "url" in lic_obj and not url_re.match(lic_obj["url"]):
+        del lic_obj["url"]
+    return None
+
+
+def sanitize_licenses(component: dict) -> None:
+    """
+    Fix a component's 'licenses' field to be CycloneDX-friendly:
     - Prefer a single 'expression'.
     - Strip invalid URLs.
     - Drop completely broken licenses.
     """
-    url_pattern = re.compile(r"^(https?|ftp)://[^\s/$.?#].[^\s]*$")
+    if "licenses" not in component:
+        return
 
-    for component in bom.get("components", []):
-        if "licenses" not in component:
+    url_re = _URL_RE
+    for lic in component["licenses"]:
+        valid_license = _first_expression(lic, url_re)
+        if valid_license:
+            component["licenses"] = [valid_license]
+            return
+
+    del component["licenses"]
+
+
+def _build_value(events, event: str, value):
+    """
+    Materialize the JSON value that starts with (event, value), consuming
+    the rest of it from the ijson basic_parse event stream.
+
+    Hand-rolled rather than ijson.ObjectBuilder: this loop runs once per
+    JSON token of the BOM and is where rewrite_bom() spends its time.
+    """
+    if event == "start_map":
+        root = {}
+    elif event == "start_array":
+        root = []
+    else:
+        return value
+
+    stack = [root]
+    push = stack.append
+    pop = stack.pop
+    key = None
+    for event, value in events:
+        if event == "map_key":
+            key = value
+            continue
+        if event == "end_map" or event == "end_array":
+            pop()
+            if not stack:
+                return root
             continue
 
-        valid_license = None
-        for lic in component["licenses"]:
-            if not isinstance(lic, dict):
-                continue
+        if event == "start_map":
+            value = {}
+        elif event == "start_array":
+            value = []
+        top = stack[-1]
+        if type(top) is dict:
+            top[key] = value
+        else:
+            top.append(value)
+        if event == "start_map" or event == "start_array":
+            push(value)
 
-            expr = lic.get("expression")
-            if isinstance(expr, str):
-                valid_license = {"expression": expr}
-                break
+    raise ValueError("BOM ended inside a JSON value")
 
-            lic_obj = lic.get("license")
-            if isinstance(lic_obj, dict):
-                if "id" in lic_obj:
-                    valid_license = {"expression": lic_obj["id"]}
-                    break
-                if "name" in lic_obj:
-                    valid_license = {"expression": lic_obj["name"]}
+
+# left out of rewrite_bom()'s content hash: serialNumber and
+# metadata.timestamp change on every syft run, and metadata.component
+# describes the scanned image (its ID and digest), not its contents
+_UNHASHED_KEYS = ("serialNumber", "metadata")
+
+
+def rewrite_bom(src, dst, service_name: str) -> str:
+    """
+    Copy a CycloneDX JSON document from src to dst with our tweaks applied:
+    - metadata.component injected if missing
+    - group set to service_name on every component
+    - licenses sanitized
+
+    Top-level arrays are streamed one item at a time, so memory stays at
+    the size of the largest single component rather than the whole BOM.
+
+    Returns a SHA-256 of the rewritten document without serialNumber and
+    metadata, so scans of two images with identical contents compare equal.
+    """
+    events = ijson.basic_parse(src, use_float=True)
+    event, _ = next(events)
+    if event != "start_map":
+        raise ValueError("BOM is not a JSON object")
+
+    default_component = {
+        "type": "application",
+        "name": service_name,
+        "version": "1.0.0",  # can be refined based on image/tag
+    }
+    has_metadata = False
+    digest = hashlib.sha256()
+
+    dst.write(b"{")
+    sep = b""
+    for event, key in events:
+        if event == "end_map":
+            break
+
+        dst.write(sep + orjson.dumps(key) + b":")
+        sep = b","
+        hashed = key not in _UNHASHED_KEYS
+        if hashed:
+            digest.update(orjson.dumps(key))
+        event, value = next(events)
+
+        if event == "start_array":
+            dst.write(b"[")
+            item_sep = b""
+            for event, value in events:
+                if event == "end_array":
                     break
-                if "url" in lic_obj:
-                    url = lic_obj["url"]
-                    if not url_pattern.match(url):
-                        lic_obj.pop("url", None)
+                item = _build_value(events, event, value)
+                if key == "components" and isinstance(item, dict):
+                    item["group"] = service_name
+                    sanitize_licenses(item)
+                data = orjson.dumps(item)
+                dst.write(item_sep + data)
+                if hashed:
+                    digest.update(data)
+                item_sep = b","
+            dst.write(b"]")
+            continue
 
-        if valid_license:
-            component["licenses"] = [valid_license]
-        else:
-            component.pop("licenses", None)
+        value = _build_value(events, event, value)
+        if key == "metadata" and isinstance(value, dict):
+            value.setdefault("component", default_component)
+            has_metadata = True
+        data = orjson.dumps(value)
+        dst.write(data)
+        if hashed:
+            digest.update(data)
+
+    if not has_metadata:
+        metadata = {"component": default_component}
+        dst.write(sep + b'"metadata":' + orjson.dumps(metadata))
+    dst.write(b"}")
+    return digest.hexdigest()
+
+
+def rewrite_bom_file(src_path: str, dst_path: str, service_name: str) -> str:
+    """
+    rewrite_bom() between two files; the unit of work sent to parse_pool().
+    """
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        return rewrite_bom(src, dst, service_name)
+
+
+def sbom_cache_path(image_id: str) -> str:
+    """
+    Cache entries are keyed on the image's content-addressable ID, so a
+    retagged or re-pulled image with unchanged content still hits.
+    """
+    cache_key = hashlib.sha256(image_id.encode("utf-8")).hexdigest()
+    return os.path.join(SBOM_CACHE_DIR, f"{cache_key}.cbom.json.zst")
+
+
+def load_cached_sbom(image_id: str, dest_path: str) -> bool:
+    """
+    Decompress the raw syft CycloneDX output cached for image_id into
+    dest_path. Returns False on a cache miss.
+    """
+    path = sbom_cache_path(image_id)
+    try:
+        with open(path, "rb") as src, open(dest_path, "wb") as dst:
+            zstandard.ZstdDecompressor().copy_stream(src, dst)
+        # mark as recently used, for prune_sbom_cache()
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        log(f"WARNING: ignoring unreadable SBOM cache entry {path}: {e}")
+        return False
+
+
+def store_cached_sbom(image_id: str, src_path: str) -> None:
+    """
+    Compress the raw syft output in src_path and atomically move it into
+    the cache.
+    """
+    path = sbom_cache_path(image_id)
+    try:
+        os.makedirs(SBOM_CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=SBOM_CACHE_DIR, suffix=".tmp")
+        try:
+            with open(src_path, "rb") as src, os.fdopen(fd, "wb") as dst:
+                zstandard.ZstdCompressor().copy_stream(src, dst)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except Exception as e:
+        log(f"WARNING: failed to write SBOM cache entry {path}: {e}")
 
 
-def get_or_create_project(name: str, hostname: str, parent_uuid: str = None) -> str | None:
+def prune_sbom_cache(running_image_ids) -> None:
+    """
+    Remove cache entries (and leftover temp files) not used for
+    SBOM_CACHE_MAX_AGE_DAYS, except those of images still running.
+    """
+    keep = {os.path.basename(sbom_cache_path(i)) for i in running_image_ids if i}
+    cutoff = time.time() - SBOM_CACHE_MAX_AGE_DAYS * 86400
+    try:
+        entries = list(os.scandir(SBOM_CACHE_DIR))
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        log(f"WARNING: failed to list SBOM cache {SBOM_CACHE_DIR}: {e}")
+        return
+
+    removed = 0
+    for entry in entries:
+        if entry.name in keep or not entry.name.endswith((".cbom.json.zst", ".tmp")):
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log(f"WARNING: failed to prune SBOM cache entry {entry.path}: {e}")
+    if removed:
+        log(f"Pruned {removed} SBOM cache entries unused for {SBOM_CACHE_MAX_AGE_DAYS} days")
+
+
+def get_or_create_project(
+    name: str, hostname: str, today: str, parent_uuid: str = None
+) -> str | None:
     """
     Parent project (no parent_uuid):
       name: "<DT_PROJECT_NAME>"
@@ -137,9 +496,10 @@ def get_or_create_project(name: str, hostname: str, parent_uuid: str = None) ->
     Child project (with parent_uuid):
       name: "<container/service name>"
       version: "<DT_PROJECT_VERSION_BASE>_<YYYYMMDD>_<last4(parent_uuid)>"
-    """
 
-    today = datetime.now(UTC).strftime("%Y%m%d")
+    today (YYYYMMDD) is passed in so every project in a scan cycle gets the
+    same date, even if the cycle runs past midnight.
+    """
 
     if parent_uuid is None:
         # parent project always uses DT_PROJECT_NAME, not container name
@@ -151,6 +511,47 @@ def get_or_create_project(name: str, hostname: str, parent_uuid: str = None) ->
         project_version = f"{DT_PROJECT_VERSION_BASE}_{today}_{parent_uuid[-4:]}"
         classifier = "CONTAINER"
 
+    cache_key = (today, project_name, project_version)
+    with _PROJECT_LOCKS[cache_key]:
+        uuid = _PROJECT_CACHE.get(cache_key)
+        if uuid is None:
+            try:
+                uuid = _find_or_create_project(
+                    project_name, project_version, classifier, hostname, parent_uuid
+                )
+            except requests.RequestException as e:
+                log(f"ERROR: Dependency-Track request failed for project {project_name}: {e}")
+                uuid = None
+            if uuid:
+                _PROJECT_CACHE[cache_key] = uuid
+    return uuid
+
+
+def prune_project_cache(today: str) -> None:
+    """
+    Forget projects (and their locks) from days other than today. Versions
+    carry the date, so these are never looked up again, and dropping them
+    daily also bounds how long a project deleted in DTrack stays cached.
+    """
+    for cache_key in list(_PROJECT_CACHE):
+        if cache_key[0] != today:
+            _PROJECT_CACHE.pop(cache_key, None)
+    for cache_key in list(_PROJECT_LOCKS):
+        if cache_key[0] != today:
+            _PROJECT_LOCKS.pop(cache_key, None)
+
+
+def _find_or_create_project(
+    project_name: str,
+    project_version: str,
+    classifier: str,
+    hostname: str,
+    parent_uuid: str | None,
+) -> str | None:
+    """
+    The Dependency-Track side of get_or_create_project(): search by
+    name/version, otherwise create and tag. Call with the project's lock held.
+    """
     # 1) search existing
     search_url = f"{DT_URL}/api/v1/project?name={project_name}&version={project_version}"
     log(f"Checking for project '{project_name}' (version {project_version})")
@@ -203,62 +604,97 @@ def get_or_create_project(name: str, hostname: str, parent_uuid: str = None) ->
     return uuid
 
 
-def run_syft(image: str, service_name: str) -> dict | None:
+def run_syft(image: str, service_name: str, image_id: str | None, workdir: str) -> tuple[str, str] | None:
     """
-    Run syft against docker:<image> via DOCKER_HOST (Podman socket).
-    Returns parsed CycloneDX JSON with metadata + tweaks.
+    Run syft against docker:<image_id> (or docker:<image> when there is no
+    ID) via DOCKER_HOST (Podman socket).
+    Writes the CycloneDX JSON with metadata + tweaks into workdir and
+    returns its path along with the content hash from rewrite_bom().
+
+    The raw syft output is cached per image_id; the tweaks are applied
+    after the cache so they can change without invalidating entries.
+    Scanning by ID rather than tag keeps the two in step: a tag moved by a
+    later pull must not get its new image's BOM stored under the ID of the
+    image the container is actually running.
     """
     if ":" not in image:
         image = image + ":latest"
 
-    log(f"Scanning {image} with syft")
-    cmd = ["syft", "-q", f"docker:{image}", "-o", "cyclonedx-json"]
-    try:
-        out = subprocess.check_output(cmd, text=True)
-    except subprocess.CalledProcessError as e:
-        log(f"ERROR: syft failed for {image}: {e}")
-        return None
+    raw_path = os.path.join(workdir, "syft.cdx.json")
+    bom_path = os.path.join(workdir, "bom.cdx.json")
 
+    use_cache = bool(image_id) and not DISABLE_SBOM_CACHE
+    cache_hit = use_cache and load_cached_sbom(image_id, raw_path)
+    if cache_hit:
+        log(f"Using cached SBOM for {image} ({image_id[:19]})")
+    else:
+        log(f"Scanning {image} with syft")
+        cmd = ["syft", "-q", f"docker:{image_id or image}", "-o", "cyclonedx-json"]
+        if image_id:
+            # name the BOM's metadata.component after the reference, not the hex ID
+            cmd += ["--source-name", image]
+        with open(raw_path, "wb") as out:
+            proc = subprocess.Popen(cmd, stdout=out, stderr=subprocess.PIPE)
+            _, err = proc.communicate()
+        if proc.returncode != 0:
+            msg = err.decode("utf-8", errors="replace").strip()
+            log(f"ERROR: syft failed for {image}: exit {proc.returncode} {msg}")
+            return None
+
+    pool = parse_pool()
     try:
-        bom = json.loads(out)
+        try:
+            content_sha256 = pool.submit(rewrite_bom_file, raw_path, bom_path, service_name).result()
+        except BrokenProcessPool:
+            # may be another job's worker that died; one retry on a fresh pool
+            pool = parse_pool(broken=pool)
+            content_sha256 = pool.submit(rewrite_bom_file, raw_path, bom_path, service_name).result()
     except Exception as e:
         log(f"ERROR: failed to parse syft output for {image}: {e}")
         return None
 
-    # inject metadata.component if missing
-    bom.setdefault("metadata", {})
-    bom["metadata"].setdefault(
-        "component",
-        {
-            "type": "application",
-            "name": service_name,
-            "version": "1.0.0",  # can be refined based on image/tag
-        },
-    )
+    if use_cache and not cache_hit:
+        store_cached_sbom(image_id, raw_path)
 
-    # set group on each component to service_name
-    for comp in bom.get("components", []):
-        comp["group"] = service_name
+    return bom_path, content_sha256
 
-    sanitize_licenses(bom)
-    return bom
 
-
-def upload_bom(project_uuid: str, bom: dict, service_name: str) -> str | None:
+def upload_bom(project_uuid: str, bom_path: str, service_name: str) -> str | None:
     """
-    Base64-encode the BOM and upload it to DTrack for the given project UUID.
+    Upload the BOM to DTrack for the given project UUID.
     Inspired by your old send_to_dtrack().
+
+    Sent as multipart/form-data with the raw BOM file as the 'bom' part, so
+    there is no base64 inflation; the encoder streams the file from disk.
+    Transient failures are retried with DT_RETRY's budget and backoff,
+    re-reading the file for each attempt.
     """
-    try:
-        bom_json = json.dumps(bom)
-    except Exception as e:
-        log(f"ERROR: failed to serialize BOM for {service_name}: {e}")
+    url = f"{DT_URL}/api/v1/bom"
+    for attempt in range(DT_RETRY.total + 1):
+        if attempt:
+            time.sleep(DT_RETRY.backoff_factor * 2 ** (attempt - 1))
+        try:
+            with open(bom_path, "rb") as f:
+                body = MultipartEncoder(
+                    fields={
+                        "project": project_uuid,
+                        "bom": ("bom.json", f, "application/json"),
+                    }
+                )
+                r = SESSION.post(url, data=body, headers={"Content-Type": body.content_type})
+        except requests.ConnectionError as e:
+            log(f"WARNING: BOM upload attempt {attempt + 1} failed for {service_name}: {e}")
+            continue
+        except Exception as e:
+            log(f"ERROR: BOM upload failed for {service_name}: {e}")
+            return None
+        if r.status_code not in DT_RETRY_STATUSES:
+            break
+        log(f"WARNING: BOM upload attempt {attempt + 1} failed for {service_name}: {r.status_code}")
+    else:
+        log(f"ERROR: BOM upload failed for {service_name} after {DT_RETRY.total + 1} attempts")
         return None
 
-    bom_encoded = base64.b64encode(bom_json.encode("utf-8")).decode("utf-8")
-    payload = {"project": project_uuid, "bom": bom_encoded}
-    url = f"{DT_URL}/api/v1/bom"
-    r = SESSION.put(url, json=payload)
     if r.status_code != 200:
         log(f"ERROR: BOM upload failed for {service_name}: {r.status_code} {r.text}")
         return None
@@ -276,67 +712,227 @@ def upload_bom(project_uuid: str, bom: dict, service_name: str) -> str | None:
     return token
 
 
-def wait_for_bom(token: str) -> None:
+def wait_for_bom(token: str, service_name: str) -> None:
     """
     Optional: poll BOM processing status like in your old script.
+
+    Polls with exponential backoff (0.25s doubling, capped at 10s) for up to
+    BOM_WAIT_SECONDS, so small BOMs are confirmed within a second or so.
     """
     url = f"{DT_URL}/api/v1/bom/token/{token}"
-    headers = {"X-Api-Key": DT_API_KEY}
-    for _ in range(10):
-        r = requests.get(url, headers=headers)
+    deadline = time.monotonic() + BOM_WAIT_SECONDS
+    delay = 0.25
+    while True:
+        try:
+            r = SESSION.get(url)
+        except Exception as e:
+            log(f"WARNING: BOM status check failed for {service_name}: {e}")
+            return
         if r.status_code != 200:
-            log(f"WARNING: BOM status check failed: {r.status_code} {r.text}")
+            log(f"WARNING: BOM status check failed for {service_name}: {r.status_code} {r.text}")
             return
-        js = r.json()
-        if not js.get("processing", False):
-            log("BOM processing completed")
+        try:
+            processing = r.json().get("processing", False)
+        except Exception as e:
+            log(f"WARNING: unexpected BOM status response for {service_name}: {e} {r.text[:200]}")
             return
-        time.sleep(5)
-    log("BOM processing may still be ongoing")
+        if not processing:
+            log(f"BOM processing completed for {service_name}")
+            return
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
+        delay = min(10, delay * 2)
+    log(f"BOM processing may still be ongoing for {service_name}")
+
+
+def process_container(c: dict, parent_uuid: str, hostname: str, today: str) -> None:
+    """
+    Full pipeline for one container: child project, syft, upload; the BOM
+    status wait is queued as a separate job on the pool.
+    Runs on a worker thread; nothing here depends on other containers.
+
+    Skipped when the container still runs the image last uploaded to the
+    same project, unless that was more than FULL_RESCAN_SECONDS ago.
+    """
+    name = c["name"]
+
+    if dt_circuit_open():
+        log(f"Dependency-Track unavailable, only scanning {name} locally")
+        scan_locally(c)
+        return
+
+    # child project per container/service
+    project_uuid = get_or_create_project(name, hostname, today, parent_uuid=parent_uuid)
+    if not project_uuid:
+        return
+
+    last = _LAST_SEEN.get(name)
+    fresh = last is not None and time.time() - last["scanned_at"] < FULL_RESCAN_SECONDS
+    if (
+        fresh
+        and c["image_id"]
+        and last["image_id"] == c["image_id"]
+        and last["project_uuid"] == project_uuid
+    ):
+        log(f"{name} unchanged, skipping")
+        return
+
+    with tempfile.TemporaryDirectory(prefix="dtrack-agent-") as workdir:
+        result = run_syft(c["image"], service_name=name, image_id=c["image_id"], workdir=workdir)
+        if not result:
+            return
+        bom_path, content_sha256 = result
+
+        if fresh and last["project_uuid"] == project_uuid and last["content_sha256"] == content_sha256:
+            # new image, same contents: nothing new for DTrack
+            log(f"{name} BOM unchanged, skipping upload")
+            _LAST_SEEN[name] = {**last, "image_id": c["image_id"]}
+            return
+
+        if dt_circuit_open():
+            # the SBOM is cached by now; upload it on a later cycle
+            log(f"Dependency-Track unavailable, not uploading BOM for {name}")
+            return
+
+        token = upload_bom(project_uuid, bom_path, service_name=name)
+        if not token:
+            return
+
+    _LAST_SEEN[name] = {
+        "image_id": c["image_id"],
+        "project_uuid": project_uuid,
+        "content_sha256": content_sha256,
+        "scanned_at": time.time(),
+    }
+
+    # don't hold up this worker's pipeline while DTrack processes the BOM
+    EXECUTOR.submit(wait_for_bom, token, name)
+
+
+def scan_locally(c: dict) -> None:
+    """
+    Syft-only pass used while the DTrack circuit is open: fills the SBOM
+    cache so the next cycle can upload without rescanning.
+    """
+    image_id = c["image_id"]
+    if DISABLE_SBOM_CACHE or not image_id or os.path.exists(sbom_cache_path(image_id)):
+        return
+    with tempfile.TemporaryDirectory(prefix="dtrack-agent-") as workdir:
+        run_syft(c["image"], service_name=c["name"], image_id=image_id, workdir=workdir)
+
+
+def submit_container(fn, c: dict, *args):
+    """
+    EXECUTOR.submit(fn, c, *args), tracking c in _IN_FLIGHT until the job
+    finishes or is cancelled. Returns None if c is already in flight.
+    """
+    name = c["name"]
+    with _IN_FLIGHT_LOCK:
+        if name in _IN_FLIGHT:
+            return None
+        _IN_FLIGHT.add(name)
+
+    def done(_):
+        with _IN_FLIGHT_LOCK:
+            _IN_FLIGHT.discard(name)
+
+    future = EXECUTOR.submit(fn, c, *args)
+    future.add_done_callback(done)
+    return future
 
 
 def main_loop():
     hostname = socket.gethostname()
     log(f"Agent starting, DT root project={DT_PROJECT_NAME}, host={hostname}")
 
-    parent_uuid = get_or_create_project(DT_PROJECT_NAME, hostname, parent_uuid=None)
-    if not parent_uuid:
-        log("ERROR: could not create/find parent project, aborting.")
-        return
-
+    local_only = False
     while True:
         log("Starting scan cycle")
+        today = datetime.now(UTC).strftime("%Y%m%d")
+        prune_project_cache(today)
+
+        # a local-only cycle is followed by another probe after the cooldown,
+        # not a full SCAN_INTERVAL_SECONDS, so uploads resume soon after DTrack
+        if local_only or dt_circuit_open():
+            log(
+                f"WARNING: most recent Dependency-Track calls failed, pausing {CIRCUIT_COOLDOWN_SECONDS}s "
+                "before probing it again"
+            )
+            time.sleep(CIRCUIT_COOLDOWN_SECONDS)
+            reset_dt_circuit()
+            local_only = not probe_dt()
+            if local_only:
+                log("WARNING: Dependency-Track still unavailable, this cycle only fills the SBOM cache")
+            else:
+                log("Dependency-Track reachable again, resuming uploads")
+
+        if not local_only:
+            parent_uuid = get_or_create_project(DT_PROJECT_NAME, hostname, today, parent_uuid=None)
+            if not parent_uuid:
+                # usually the first sign of an outage (on a new day nothing is
+                # cached yet), so take the same cooldown/probe path as the breaker
+                log("ERROR: could not create/find parent project, this cycle only fills the SBOM cache")
+                local_only = True
+
         containers = discover_containers()
         if not containers:
             log("No containers discovered, sleeping")
-            time.sleep(SCAN_INTERVAL_SECONDS)
+            if not local_only:
+                time.sleep(SCAN_INTERVAL_SECONDS)
             continue
 
-        log("Intended project structure:")
-        log(f"  {DT_PROJECT_NAME}")
-        for c in containers:
-            if c["image"]:
-                log(f"    └─ {c['name']}")
+        # forget containers that are gone, so they get a full scan if they return
+        names = {c["name"] for c in containers}
+        for name in list(_LAST_SEEN):
+            if name not in names:
+                _LAST_SEEN.pop(name, None)
 
-        for c in containers:
-            name = c["name"]
-            image = c["image"]
-            if not image:
-                continue
-
-            # child project per container/service
-            project_uuid = get_or_create_project(name, hostname, parent_uuid=parent_uuid)
-            if not project_uuid:
-                continue
+        if not DISABLE_SBOM_CACHE:
+            prune_sbom_cache(c["image_id"] for c in containers)
 
-            bom = run_syft(image, service_name=name)
-            if not bom:
+        if local_only:
+            job = (scan_locally,)
+        else:
+            log("Intended project structure:")
+            log(f"  {DT_PROJECT_NAME}")
+            for c in containers:
+                if c["image"]:
+                    log(f"    └─ {c['name']}")
+            job = (process_container, parent_uuid, hostname, today)
+
+        futures = {}
+        busy = []
+        for c in containers:
+            if not c["image"]:
                 continue
-
-            token = upload_bom(project_uuid, bom, service_name=name)
-            if token:
-                wait_for_bom(token)
-
+            f = submit_container(job[0], c, *job[1:])
+            if f is None:
+                busy.append(c["name"])
+            else:
+                futures[f] = c["name"]
+        if busy:
+            log("WARNING: still scanning from an earlier cycle, skipping: " + ", ".join(sorted(busy)))
+
+        done, not_done = wait(futures, timeout=SCAN_INTERVAL_SECONDS)
+
+        for f in done:
+            if f.exception() is not None:
+                log(f"ERROR: processing {futures[f]} failed: {f.exception()}")
+
+        if not_done:
+            for f in not_done:
+                f.cancel()
+            log(
+                f"WARNING: {len(not_done)} containers not done after {SCAN_INTERVAL_SECONDS}s: "
+                + ", ".join(sorted(futures[f] for f in not_done))
+            )
+
+        if local_only:
+            log("Local-only cycle done")
+            continue
         log(f"Scan cycle done, sleeping {SCAN_INTERVAL_SECONDS}s")
         time.sleep(SCAN_INTERVAL_SECONDS)
 
@@ -1,12 +1,23 @@
 import os
+import sys
+import codecs
+import struct
 import time
-import json
-import threading
+import signal
+import asyncio
 import logging
-from typing import Dict, Set
+from datetime import datetime, UTC
+from typing import Callable, Dict
 
-import requests_unixsocket
-from opensearchpy import OpenSearch, RequestsHttpConnection
+import aiohttp
+import orjson
+from opensearchpy import AsyncOpenSearch, helpers
+
+try:
+    # libuv-based event loop; faster socket fan-in than the default selector loop
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # -----------------------------------------------------------------------------
 # Config
@@ -15,7 +26,27 @@ PODMAN_SOCKET_PATH = os.getenv("PODMAN_SOCKET_PATH", "/run/podman/podman.sock")
 OPENSEARCH_URL = os.getenv("OPENSEARCH_URL", "http://opensearch:9200")
 OPENSEARCH_INDEX_PREFIX = os.getenv("OPENSEARCH_INDEX_PREFIX", "podman-logs")
 NODE_NAME = os.getenv("NODE_NAME", "podman-node")
-DISCOVERY_INTERVAL_SECONDS = int(os.getenv("DISCOVERY_INTERVAL_SECONDS", "10"))
+# Full container listing, as a safety net next to the Podman event stream
+DISCOVERY_INTERVAL_SECONDS = int(os.getenv("DISCOVERY_INTERVAL_SECONDS", "300"))
+EVENTS_RETRY_SECONDS = 5
+# a followed stream ends by itself once the container has exited; this only
+# bounds how long one may keep draining after the died event
+STREAM_DRAIN_SECONDS = 30
+# on SIGTERM, how long the last bulk requests may take; podman stop sends
+# SIGKILL 10s after SIGTERM by default
+SHUTDOWN_FLUSH_SECONDS = 8
+STREAM_CHUNK_SIZE = 64 * 1024
+MAX_LINE_CHARS = 1024 * 1024
+
+# Podman multiplexes stdout/stderr of non-TTY containers into frames of an
+# 8-byte header (stream type, 3 zero bytes, big-endian payload size) + payload
+_FRAME_HEADER = struct.Struct(">BxxxI")
+_STREAM_NAMES = {0: "stdin", 1: "stdout", 2: "stderr"}
+MAX_STREAMS = int(os.getenv("MAX_STREAMS", "200"))
+BULK_MAX_DOCS = int(os.getenv("BULK_MAX_DOCS", "500"))
+BULK_MAX_BYTES = int(os.getenv("BULK_MAX_BYTES", str(5 * 1024 * 1024)))
+BULK_MAX_WAIT_SECONDS = float(os.getenv("BULK_MAX_WAIT_SECONDS", "2"))
+BULK_QUEUE_SIZE = int(os.getenv("BULK_QUEUE_SIZE", "10000"))
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 AGENT_MODE = os.getenv("AGENT_MODE", "opensearch").lower()  # "opensearch" or "local"
 
@@ -28,17 +59,16 @@ logger = logging.getLogger(__name__)
 # -----------------------------------------------------------------------------
 # Clients
 # -----------------------------------------------------------------------------
-# Unix socket session for Podman API
-session = requests_unixsocket.Session()
-PODMAN_BASE_URL = f"http+unix://{PODMAN_SOCKET_PATH.replace('/', '%2F')}"
+# Podman API is reached through an aiohttp UnixConnector; the host part of the
+# URL is ignored. The session itself is created inside the event loop (main).
+PODMAN_BASE_URL = "http://podman"
 
 # OpenSearch client (lazy init; only when needed)
 opensearch_client = None
 if AGENT_MODE == "opensearch":
     try:
-        opensearch_client = OpenSearch(
+        opensearch_client = AsyncOpenSearch(
             hosts=[OPENSEARCH_URL],
-            connection_class=RequestsHttpConnection,
             use_ssl=OPENSEARCH_URL.startswith("https"),
             verify_certs=False,  # change to True + CA bundle in production
         )
@@ -46,19 +76,27 @@ if AGENT_MODE == "opensearch":
     except Exception as e:
         logger.error("Failed to init OpenSearch client: %s", e)
 
+# Bulk actions waiting for flush_logs(); bounded so a slow OpenSearch pushes
+# back on the log streams instead of growing memory without limit. A None
+# entry tells flush_logs() to send what it has and return.
+log_queue: asyncio.Queue = asyncio.Queue(maxsize=BULK_QUEUE_SIZE)
+
+# Daily index name, recomputed only when the UTC day changes
+_INDEX_CACHE = {"day": None, "name": None}
+
 
 # -----------------------------------------------------------------------------
 # Helpers
 # -----------------------------------------------------------------------------
-def list_containers() -> Dict[str, str]:
+async def list_containers(session: aiohttp.ClientSession) -> Dict[str, str]:
     """
     Returns {container_id: name} for all running containers using Podman API.
     """
     url = f"{PODMAN_BASE_URL}/v4.0.0/libpod/containers/json"
     try:
-        r = session.get(url)
-        r.raise_for_status()
-        containers = r.json()
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as r:
+            r.raise_for_status()
+            containers = await r.json()
     except Exception as e:
         logger.error("Error listing containers via Podman API: %s", e)
         return {}
@@ -73,7 +111,7 @@ def list_containers() -> Dict[str, str]:
     return out
 
 
-def send_log(doc: dict):
+async def send_log(doc: dict):
     """
     Sends a log doc either to OpenSearch or stdout depending on AGENT_MODE.
     """
@@ -85,7 +123,7 @@ def send_log(doc: dict):
         doc_print = dict(doc)
         if len(msg) > 300:
             doc_print["message"] = msg[:300] + "...[truncated]"
-        print(json.dumps(doc_print, ensure_ascii=False))
+        sys.stdout.buffer.write(orjson.dumps(doc_print, option=orjson.OPT_APPEND_NEWLINE))
         return
 
     # Default: OpenSearch mode
@@ -93,14 +131,114 @@ def send_log(doc: dict):
         logger.error("OpenSearch client not initialized, cannot send log")
         return
 
-    index_name = f"{OPENSEARCH_INDEX_PREFIX}-{time.strftime('%Y.%m.%d')}"
-    try:
-        opensearch_client.index(index=index_name, body=doc)
-    except Exception as e:
-        logger.error("Failed to index log line: %s", e)
+    today = int(time.time()) // 86400
+    if today != _INDEX_CACHE["day"]:
+        _INDEX_CACHE.update(
+            day=today,
+            name=f"{OPENSEARCH_INDEX_PREFIX}-{time.strftime('%Y.%m.%d', time.gmtime())}",
+        )
+    await log_queue.put({"_index": _INDEX_CACHE["name"], "_source": doc})
 
 
-def stream_logs(container_id: str, name: str):
+async def flush_logs():
+    """
+    Drain log_queue into OpenSearch bulk requests. A batch is sent once it
+    holds BULK_MAX_DOCS docs, roughly BULK_MAX_BYTES of messages, or has
+    waited BULK_MAX_WAIT_SECONDS since its first doc, whichever comes first.
+
+    Returns after sending everything queued ahead of a None entry.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = False
+
+    while not stopping:
+        action = await log_queue.get()
+        if action is None:
+            return
+        actions = [action]
+        # approximate: message length plus a fixed allowance for the other fields
+        size = len(action["_source"].get("message", "")) + 200
+        deadline = loop.time() + BULK_MAX_WAIT_SECONDS
+
+        while len(actions) < BULK_MAX_DOCS and size < BULK_MAX_BYTES:
+            try:
+                action = log_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    action = await asyncio.wait_for(log_queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if action is None:
+                stopping = True
+                break
+            actions.append(action)
+            size += len(action["_source"].get("message", "")) + 200
+
+        try:
+            _, errors = await helpers.async_bulk(
+                opensearch_client, actions, raise_on_error=False, raise_on_exception=False
+            )
+            if errors:
+                logger.error("Failed to index %d of %d log lines", len(errors), len(actions))
+        except Exception as e:
+            logger.error("Failed to index %d log lines: %s", len(actions), e)
+
+
+def log_doc(line: str, stream: str, container_id: str, name: str) -> dict:
+    """
+    Build the document stored for one log line.
+    """
+    return {
+        "@timestamp": datetime.now(UTC).isoformat(timespec="milliseconds"),
+        "message": line,
+        "stream": stream,
+        "container_id": container_id,
+        "container_name": name,
+        "node": NODE_NAME,
+    }
+
+
+def is_framed(buf: bytearray) -> bool:
+    """
+    True if buf starts with a multiplexed frame header. TTY containers
+    send a raw stream instead.
+    """
+    return buf[0] in _STREAM_NAMES and buf[1:4] == b"\0\0\0"
+
+
+def split_frames(buf: bytearray) -> list:
+    """
+    Pop every complete frame off the front of buf and return its lines as
+    (stream, line) pairs. A trailing partial frame is left in buf.
+    """
+    out = []
+    off = 0
+    end = len(buf)
+    with memoryview(buf) as mv:
+        while end - off >= _FRAME_HEADER.size:
+            stream, size = _FRAME_HEADER.unpack_from(mv, off)
+            start = off + _FRAME_HEADER.size
+            if start + size > end:
+                break
+            stream_name = _STREAM_NAMES.get(stream, "stdout")
+            for line in str(mv[start : start + size], "utf-8", "replace").split("\n"):
+                line = line.rstrip("\r")
+                if line:
+                    out.append((stream_name, line))
+            off = start + size
+    del buf[:off]
+    return out
+
+
+async def stream_logs(
+    session: aiohttp.ClientSession,
+    semaphore: asyncio.Semaphore,
+    container_id: str,
+    name: str,
+):
     """
     Follow logs for a single container and send to OpenSearch or stdout.
     """
@@ -109,71 +247,195 @@ def stream_logs(container_id: str, name: str):
         "?stdout=1&stderr=1&follow=1&since=0&timestamps=1"
     )
 
-    logger.info("Starting log stream for %s (%s)", name, container_id[:12])
+    async with semaphore:
+        logger.info("Starting log stream for %s (%s)", name, container_id[:12])
 
-    try:
-        with session.get(url, stream=True) as r:
-            r.raise_for_status()
-            for raw_line in r.iter_lines():
-                if not raw_line:
-                    continue
-                try:
-                    line = raw_line.decode("utf-8", errors="replace")
-                except Exception:
-                    line = str(raw_line)
-
-                doc = {
-                    "@timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
-                    "message": line,
-                    "container_id": container_id,
-                    "container_name": name,
-                    "node": NODE_NAME,
-                }
-
-                send_log(doc)
-    except Exception as e:
-        logger.error("Error streaming logs for %s (%s): %s", name, container_id[:12], e)
+        try:
+            # followed streams stay open indefinitely, so no total timeout
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=None)) as r:
+                r.raise_for_status()
+                buf = bytearray()
+                framed = None
+                # raw (TTY) streams: decode whole chunks (multi-byte chars may
+                # straddle them) and split lines in str
+                decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+                pending = ""
+
+                async for chunk in r.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    buf += chunk
+                    if framed is None:
+                        if len(buf) < _FRAME_HEADER.size:
+                            continue
+                        framed = is_framed(buf)
+
+                    if framed:
+                        entries = split_frames(buf)
+                    else:
+                        *lines, pending = (pending + decoder.decode(buf)).split("\n")
+                        buf.clear()
+                        if len(pending) > MAX_LINE_CHARS:
+                            lines.append(pending)
+                            pending = ""
+                        entries = [("stdout", line.rstrip("\r")) for line in lines]
+
+                    for stream, line in entries:
+                        if line:
+                            await send_log(log_doc(line, stream, container_id, name))
+
+                # last line of a raw stream that ended without a newline
+                if not framed:
+                    line = (pending + decoder.decode(buf, final=True)).rstrip("\r")
+                    if line:
+                        await send_log(log_doc(line, "stdout", container_id, name))
+        except Exception as e:
+            logger.error("Error streaming logs for %s (%s): %s", name, container_id[:12], e)
+
+        logger.info("Log stream ended for %s (%s)", name, container_id[:12])
+
+
+async def watch_events(
+    session: aiohttp.ClientSession,
+    on_start: Callable[[str, str], None],
+    on_stop: Callable[[str], None],
+):
+    """
+    Subscribe to Podman's container start/died events and call on_start /
+    on_stop as they arrive. Reconnects if the event stream drops.
+    """
+    url = f"{PODMAN_BASE_URL}/v4.0.0/libpod/events"
+    params = {
+        "stream": "true",
+        "filters": orjson.dumps({"type": ["container"], "event": ["start", "died"]}).decode(),
+    }
+
+    while True:
+        try:
+            async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=None)) as r:
+                r.raise_for_status()
+                logger.info("Subscribed to Podman container events")
+                async for raw_line in r.content:
+                    raw_line = raw_line.strip()
+                    if not raw_line:
+                        continue
+                    evt = orjson.loads(raw_line)
+                    if evt.get("Type") != "container":
+                        continue
+
+                    cid = evt.get("ID") or evt.get("Actor", {}).get("ID")
+                    if not cid:
+                        continue
+                    status = evt.get("Status") or evt.get("Action")
+                    if status == "start":
+                        name = evt.get("Actor", {}).get("Attributes", {}).get("name") or cid[:12]
+                        on_start(cid, name)
+                    elif status in ("died", "die"):
+                        on_stop(cid)
+        except Exception as e:
+            logger.error("Error reading Podman events: %s", e)
 
-    logger.info("Log stream ended for %s (%s)", name, container_id[:12])
+        logger.info("Podman event stream ended, reconnecting in %ss", EVENTS_RETRY_SECONDS)
+        await asyncio.sleep(EVENTS_RETRY_SECONDS)
 
 
 # -----------------------------------------------------------------------------
 # Main discovery loop
 # -----------------------------------------------------------------------------
-def main():
+async def main():
     logger.info("Starting OpenSearch agent")
     logger.info("Mode: %s", AGENT_MODE)
     logger.info("Podman socket: %s", PODMAN_SOCKET_PATH)
+    logger.info("Event loop: %s", "uvloop" if uvloop is not None else "asyncio")
 
-    active_streams: Set[str] = set()
-    threads: Dict[str, threading.Thread] = {}
+    # MAX_STREAMS bounds concurrent streams, so the connector itself is unbounded
+    connector = aiohttp.UnixConnector(path=PODMAN_SOCKET_PATH, limit=0)
+    semaphore = asyncio.Semaphore(MAX_STREAMS)
+    tasks: Dict[str, asyncio.Task] = {}
 
-    while True:
-        containers = list_containers()
-        logger.debug("Discovered containers: %s", containers)
-
-        for cid, name in containers.items():
-            if cid not in active_streams:
-                logger.info("Starting log collector for container %s (%s)", name, cid[:12])
-                t = threading.Thread(
-                    target=stream_logs,
-                    args=(cid, name),
-                    daemon=True,
-                    name=f"log-{name}",
-                )
-                t.start()
-                active_streams.add(cid)
-                threads[cid] = t
-
-        # Clean up threads that died
-        dead = [cid for cid, t in threads.items() if not t.is_alive()]
-        for cid in dead:
-            logger.info("Cleaning up dead log stream for %s", cid[:12])
-            active_streams.discard(cid)
-            threads.pop(cid, None)
-
-        time.sleep(DISCOVERY_INTERVAL_SECONDS)
+    # streams untracked by stop_stream() but still draining
+    draining: set = set()
+
+    # podman stop / systemd send SIGTERM: stop the streams, then send what
+    # is still queued before exiting
+    shutdown = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, shutdown.set)
+
+    flusher = None
+    if opensearch_client is not None:
+        # outside the TaskGroup, so it outlives the streams and can drain
+        flusher = asyncio.create_task(flush_logs(), name="bulk-flush")
+
+    try:
+        # read_bufsize also caps the length of a single event line
+        async with aiohttp.ClientSession(connector=connector, read_bufsize=2**20) as session:
+            async with asyncio.TaskGroup() as tg:
+
+                def start_stream(cid: str, name: str):
+                    t = tasks.get(cid)
+                    if t is not None and not t.done():
+                        return
+                    logger.info("Starting log collector for container %s (%s)", name, cid[:12])
+                    tasks[cid] = tg.create_task(
+                        stream_logs(session, semaphore, cid, name),
+                        name=f"log-{name}",
+                    )
+
+                def stop_stream(cid: str):
+                    # untrack right away so a restart gets its own stream, but
+                    # let this one drain: its last lines are the crash output
+                    t = tasks.pop(cid, None)
+                    if t is not None and not t.done():
+                        logger.info("Container %s died, draining log stream", cid[:12])
+                        draining.add(t)
+                        t.add_done_callback(draining.discard)
+                        loop.call_later(STREAM_DRAIN_SECONDS, t.cancel)
+
+                events = tg.create_task(watch_events(session, start_stream, stop_stream), name="events")
+
+                while not shutdown.is_set():
+                    containers = await list_containers(session)
+                    logger.debug("Discovered containers: %s", containers)
+
+                    for cid, name in containers.items():
+                        start_stream(cid, name)
+
+                    # Clean up streams that ended
+                    dead = [cid for cid, t in tasks.items() if t.done()]
+                    for cid in dead:
+                        logger.info("Cleaning up dead log stream for %s", cid[:12])
+                        tasks.pop(cid, None)
+
+                    try:
+                        await asyncio.wait_for(shutdown.wait(), DISCOVERY_INTERVAL_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+
+                logger.info("Shutting down, stopping log streams")
+                events.cancel()
+                for t in [*tasks.values(), *draining]:
+                    t.cancel()
+    finally:
+        if flusher is not None:
+
+            async def drain():
+                if not flusher.done():
+                    await log_queue.put(None)
+                await flusher
+
+            try:
+                await asyncio.wait_for(drain(), SHUTDOWN_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                logger.error("Gave up flushing %d queued log lines on shutdown", log_queue.qsize())
+            except Exception as e:
+                logger.error("Final flush failed: %s", e)
+        if opensearch_client is not None:
+            await opensearch_client.close()
+        logger.info("OpenSearch agent stopped")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())